@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Export rsyslog counters as prometheus metrics (impstats via omprog)
 
@@ -21,39 +21,69 @@ limitations under the License.
 __version__ = '1.0'
 
 import os
-import re
+import string
 import sys
 import time
 import json
-import select
+import queue
 import argparse
-import collections
+import threading
+import functools
 from prometheus_client import start_http_server, Summary
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
 
+try:
+    # orjson parses bytes directly and is noticeably faster than stdlib json
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 PARSE_TIME = Summary('rsyslog_exporter_parsing_seconds', 'Time spent on parsing input')
 COLLECT_TIME = Summary('rsyslog_exporter_collecting_seconds', 'Time spent on collecting metrics')
 
 
-def dbg(msg):
-    """ Print [debug] message to stderr """
-    sys.stderr.write("%s\n" % msg)
-    sys.stderr.flush()
+class _MetricNameTable(dict):
+    """ str.translate() table replacing any char not allowed in metric names with '_' """
+    def __missing__(self, key):
+        return '_'
+
+
+_METRIC_NAME_TABLE = _MetricNameTable((c, c) for c in map(ord, string.ascii_letters + string.digits + '_'))
+
+# Stats fields which are not counters
+_SKIP_KEYS = frozenset(('origin', 'name'))
+
+
+@functools.lru_cache(maxsize=4096)
+def _fix_metric_name(metric):
+    """ Convert rsyslog stats field name into valid metric name part """
+    m = metric.lower().translate(_METRIC_NAME_TABLE)
+    # Usually 0-1 passes; measured faster than '_'.join() over m.split('_')
+    while '__' in m:
+        m = m.replace('__', '_')
+    return m.strip('_')
 
 
 class RsyslogStats(object):
     """ Class to parse and collect rsyslog stats """
+    __slots__ = (
+        '_current', 'is_up', '_is_exported', 'parser_failures',
+        'stats_count', 'export_time', 'labels', '_name_cache', '_families',
+    )
     metric_prefix = 'rsyslog'
 
     def __init__(self):
-        self._current = collections.defaultdict(dict)
-        self._exported = collections.defaultdict(dict)
+        # Counters are stored as {(metric_name, name): value}
+        self._current = {}
         self.is_up = False
         self._is_exported = True
         self.parser_failures = 0
         self.stats_count = 0
         self.export_time = 0
         self.labels = {}
+        self._name_cache = {}
+        self._families = []
 
     def parser_failure(self):
         self.parser_failures += 1
@@ -63,45 +93,54 @@ class RsyslogStats(object):
         return self._is_exported
 
     def export(self):
-        self._exported = self._current
-        self._current = collections.defaultdict(dict)
+        self._families = self._make_families(self._current)
+        self._current = {}
         self._is_exported = True
         self.export_time = time.time()
 
-    def counters(self):
-        return self._exported
+    def families(self):
+        return self._families
+
+    def _make_families(self, counters):
+        """ Build metric families for exported counters (reused by every scrape) """
+        label_names = ('name',) + tuple(self.labels)
+        # add_metric() copies label values, so one list is reused for all values
+        label_values = [None] + list(self.labels.values())
+
+        families = {}
+        for (metric_name, name), value in counters.items():
+            m = families.get(metric_name)
+            if m is None:
+                if metric_name == 'rsyslog_core_queue_size':
+                    m = GaugeMetricFamily(metric_name, '', labels=label_names)
+                else:
+                    m = CounterMetricFamily(metric_name, '', labels=label_names)
+                families[metric_name] = m
 
-    def add(self, metric_name, name, value):
-        self._current[metric_name][name] = value
+            label_values[0] = name
+            m.add_metric(label_values, value)
 
-    def dump(self, kind='c', prefix=''):
-        if kind == 'c':
-            metrics = self._current
-        else:
-            metrics = self._exported
+        return list(families.values())
 
-        dbg("%s====" % (prefix))
-        for k, v in metrics.items():
-            for kk, vv in v.items():
-                dbg("%s%s{label=\"%s\"}: %s" % (prefix, k, kk, vv))
-        dbg("%s...." % (prefix))
+    def _metric_name(self, origin, key):
+        """ Build (and cache) metric name for <origin>.<key> stats field """
+        k = (origin, key)
+        v = self._name_cache.get(k)
+        if v is None:
+            v = self.metric_prefix + '_' + _fix_metric_name(origin) + '_' + _fix_metric_name(key)
+            self._name_cache[k] = v
+        return v
 
-    def _fix_metric_name(self, metric):
-        m = re.sub('[^_a-zA-Z0-9]', '_', metric.lower())
-        m = re.sub('_+', '_', m)
-        m = m.strip('_')
-        return m
-
-    @PARSE_TIME.time()
     def parse(self, statline):
-        if not self.is_up:
-            self.is_up = True
-
         try:
-            stats = json.loads(statline)
+            stats = _loads(statline)
         except ValueError:
+            # orjson.JSONDecodeError is a subclass of ValueError
             return self.parser_failure()
 
+        if not self.is_up:
+            self.is_up = True
+
         if 'name' not in stats:
             return self.parser_failure()
 
@@ -115,30 +154,34 @@ class RsyslogStats(object):
 
         origin = stats['origin']
         name = stats['name']
-        metric_basename = self.metric_prefix + '_' + self._fix_metric_name(origin)
 
-        if name == 'global':
-            if not self._is_exported:
-                self.export()
+        if name == 'global' and not self._is_exported:
+            self.export()
 
+        # Hoist lookups out of the loops below (export() above swaps _current)
+        current = self._current
+        metric_name_of = self._metric_name
+
+        if name == 'global':
             # Special case for first line ("name":"global").
             # There are dynamic stats fields reported in <name>.<field> format
             for k, v in stats['values'].items():
                 n, c = k.split('.')
-                metric_name = metric_basename + '_' + self._fix_metric_name(c)
-                self.add(metric_name, n, v)
+                current[(metric_name_of(origin, c), n)] = v
 
         else:
             for k, v in stats.items():
-                metric_name = metric_basename + '_' + self._fix_metric_name(k)
-                if k not in ['origin', 'name']:
-                    if k != 'values':
-                        self.add(metric_name, name, v)
+                if k in _SKIP_KEYS:
+                    continue
+                if k != 'values':
+                    current[(metric_name_of(origin, k), name)] = v
+                else:
+                    if origin == 'dynstats.bucket':
+                        metric_name = self.metric_prefix + '_dynstats_' + _fix_metric_name(name)
                     else:
-                        if origin == 'dynstats.bucket':
-                            metric_name = self.metric_prefix + '_dynstats_' + self._fix_metric_name(name)
-                        for kk, vv in v.items():
-                            self.add(metric_name, kk, vv)
+                        metric_name = metric_name_of(origin, k)
+                    for kk, vv in v.items():
+                        current[(metric_name, kk)] = vv
 
         if self._is_exported:
             self.stats_count = 0
@@ -149,19 +192,21 @@ class RsyslogStats(object):
 
 class RsyslogCollector(object):
     """ Custom prometheus collector class """
+    __slots__ = ('_stats',)
+
     def __init__(self, stats):
         self._stats = stats
 
     @COLLECT_TIME.time()
     def collect(self):
-        custom_label_names = self._stats.labels.keys()
-        custom_label_values = self._stats.labels.values()
+        custom_label_names = tuple(self._stats.labels)
+        custom_label_values = tuple(self._stats.labels.values())
 
         m = GaugeMetricFamily(
             'rsyslog_exporter_version',
             'Version of rsyslog_exporter running',
-            labels=['version'] + custom_label_names)
-        m.add_metric([__version__] + custom_label_values, 1.0)
+            labels=('version',) + custom_label_names)
+        m.add_metric((__version__,) + custom_label_values, 1.0)
         yield m
 
         m = GaugeMetricFamily(
@@ -195,16 +240,7 @@ class RsyslogCollector(object):
         if not self._stats.is_up:
             return
 
-        label_names = ['name'] + custom_label_names
-
-        for metric_name, v in self._stats.counters().items():
-            if metric_name == 'rsyslog_core_queue_size':
-                m = GaugeMetricFamily(metric_name, '', labels=label_names)
-            else:
-                m = CounterMetricFamily(metric_name, '', labels=label_names)
-
-            for name, value in v.items():
-                m.add_metric([name] + custom_label_values, value)
+        for m in self._stats.families():
             yield m
 
 
@@ -247,6 +283,13 @@ def parse_args():
         default=os.environ.get('RSYSLOG_EXPORTER_LABELS', '').split(','),
         dest='labels',
     )
+    parser.add_argument(
+        '-P', '--profile-parsing',
+        help='Measure time spent on parsing every stats line (rsyslog_exporter_parsing_seconds metric)',
+        action='store_true',
+        default=os.environ.get('RSYSLOG_EXPORTER_PROFILE_PARSING', '').lower() in ('1', 'true', 'yes', 'on'),
+        dest='profile_parsing',
+    )
     return parser.parse_args()
 
 
@@ -262,6 +305,15 @@ def parse_labels(key_values):
     return labels
 
 
+def read_lines(stream, lines):
+    """ Pass lines read from stream to the lines queue. None marks EOF """
+    try:
+        for line in stream:
+            lines.put(line)
+    finally:
+        lines.put(None)
+
+
 def main():
     """ Main procedure """
     try:
@@ -274,21 +326,30 @@ def main():
         stats = RsyslogStats()
         stats.labels = parse_labels(args.labels)
 
-        # Make stdin unbuffered
-        stdin_unbuf = os.fdopen(sys.stdin.fileno(), 'rb', 0)
-        sys.stdin = stdin_unbuf
+        # Read stdin as buffered binary stream. Buffered reads on a pipe return
+        # whatever is available, so lines are still handled as they arrive
+        sys.stdin = os.fdopen(sys.stdin.fileno(), 'rb', 65536)
 
         # Start http server thread to expose metrics
         start_http_server(args.port)
         REGISTRY.register(RsyslogCollector(stats))
+        if not args.profile_parsing:
+            REGISTRY.unregister(PARSE_TIME)
+
+        # Blocking reads are done in background, timeouts are handled here
+        lines = queue.SimpleQueue()
+        reader = threading.Thread(target=read_lines, args=(sys.stdin, lines))
+        reader.daemon = True
+        reader.start()
 
         sleep_seconds = args.down_after
         silent_seconds = 0
-        keep_running = True
-        while keep_running:
+        while True:
 
             sleep_start = time.time()
-            if sys.stdin not in select.select([sys.stdin], [], [], sleep_seconds)[0]:
+            try:
+                line = lines.get(timeout=sleep_seconds)
+            except queue.Empty:
                 sleep_end = time.time()
                 slept_seconds = abs(sleep_end - sleep_start)
                 silent_seconds += slept_seconds
@@ -306,19 +367,26 @@ def main():
                         sleep_seconds = args.down_after - slept_seconds
                     else:
                         sleep_seconds = args.export_after - slept_seconds
+                continue
 
+            if line is None:
+                # Exit when EOF received on stdin
+                break
+
+            silent_seconds = 0
+            sleep_seconds = args.export_after
+
+            # impstats output usually comes without any syslog prefix
+            if line[:1] != b'{':
+                json_start_idx = line.find(b'{')
+                json_end_idx = line.rfind(b'}')
+                line = line[json_start_idx:json_end_idx + 1]
+
+            if args.profile_parsing:
+                with PARSE_TIME.time():
+                    stats.parse(line)
             else:
-                silent_seconds = 0
-                sleep_seconds = args.export_after
-                while keep_running and sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-                    line = sys.stdin.readline()
-                    if line:
-                        json_start_idx = line.find('{')
-                        json_end_idx = line.rfind('}')
-                        stats.parse(line[json_start_idx:json_end_idx + 1])
-                    else:
-                        # Exit when EOF received on stdin
-                        keep_running = False
+                stats.parse(line)
 
     except KeyboardInterrupt:
         sys.stderr.write("Interrupted!\n")